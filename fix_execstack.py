@@ -6,35 +6,59 @@ ORT MLAS assembly marks the stack as executable (RWE). Newer kernels
 program header to change RWE -> RW (clears PF_X flag).
 """
 import glob
+import os
 import struct
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 PT_GNU_STACK = 0x6474E551
 PF_X = 0x1
 
-for pattern in sys.argv[1:]:
-    for so in glob.glob(pattern, recursive=True):
-        with open(so, "r+b") as f:
-            magic = f.read(4)
-            if magic != b"\x7fELF":
-                continue
-            ei_class = f.read(1)[0]
-            if ei_class != 2:  # 64-bit only
-                continue
-            f.seek(32)
-            e_phoff = struct.unpack("<Q", f.read(8))[0]
-            f.seek(54)
-            e_phentsize = struct.unpack("<H", f.read(2))[0]
-            e_phnum = struct.unpack("<H", f.read(2))[0]
-            for i in range(e_phnum):
-                off = e_phoff + i * e_phentsize
-                f.seek(off)
-                p_type = struct.unpack("<I", f.read(4))[0]
-                if p_type != PT_GNU_STACK:
-                    continue
-                p_flags = struct.unpack("<I", f.read(4))[0]
-                if p_flags & PF_X:
-                    f.seek(off + 4)
-                    f.write(struct.pack("<I", p_flags & ~PF_X))
-                    print(f"Cleared execstack: {so}")
-                break
+# Elf64_Phdr
+PHDR = np.dtype([
+    ("p_type", "<u4"), ("p_flags", "<u4"), ("p_offset", "<u8"), ("p_vaddr", "<u8"),
+    ("p_paddr", "<u8"), ("p_filesz", "<u8"), ("p_memsz", "<u8"), ("p_align", "<u8"),
+])
+
+# Covers the ELF header and program header table of any ordinary shared object.
+HEAD_SIZE = 4096
+
+
+def patch(so):
+    """Clear PF_X on so's PT_GNU_STACK entry. Returns True if the file changed."""
+    with open(so, "rb") as f:
+        buf = f.read(HEAD_SIZE)
+        if buf[:4] != b"\x7fELF" or len(buf) < 64:
+            return False
+        if buf[4] != 2:  # 64-bit only
+            return False
+        e_phoff = struct.unpack_from("<Q", buf, 32)[0]
+        e_phentsize, e_phnum = struct.unpack_from("<HH", buf, 54)
+        end = e_phoff + e_phnum * e_phentsize
+        if end > len(buf):
+            f.seek(0)
+            buf = f.read(end)
+
+    pht = np.ndarray((e_phnum,), dtype=PHDR, buffer=buf, offset=e_phoff, strides=(e_phentsize,))
+    idx = np.flatnonzero(pht["p_type"] == PT_GNU_STACK)
+    if not idx.size:
+        return False
+    i = int(idx[0])
+    p_flags = int(pht["p_flags"][i])
+    if not p_flags & PF_X:
+        return False
+    fd = os.open(so, os.O_WRONLY)
+    try:
+        os.pwrite(fd, struct.pack("<I", p_flags & ~PF_X), e_phoff + i * e_phentsize + 4)
+    finally:
+        os.close(fd)
+    return True
+
+
+paths = [so for pattern in sys.argv[1:] for so in glob.glob(pattern, recursive=True)]
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+    for so, changed in zip(paths, pool.map(patch, paths)):
+        if changed:
+            print(f"Cleared execstack: {so}")
@@ -1,13 +1,24 @@
-import io
+import asyncio
+import functools
+import glob
+import hashlib
 import os
 import logging
+import platform
+import re
+import struct
+import sys
+import tempfile
+from collections import OrderedDict
+from typing import Annotated, Iterator
+import msgspec
+import numpy as np
 import onnxruntime as ort
-import soundfile as sf
+from onnxruntime.capi.onnxruntime_pybind11_state import Fail as OrtFail
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import Response
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Literal
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 logger = logging.getLogger(__name__)
@@ -15,38 +26,420 @@ logger = logging.getLogger(__name__)
 MODEL_ID = os.environ.get("KITTENTTS_MODEL", "KittenML/kitten-tts-mini-0.8")
 SAMPLE_RATE = 24000
 
+# Concurrent requests are queued and drained by a single worker: whatever is
+# already waiting (up to KITTENTTS_BATCH_SIZE) is grouped by input length and
+# synthesized back to back, starting immediately.
+BATCH_SIZE = int(os.environ.get("KITTENTTS_BATCH_SIZE", "8"))
+LENGTH_BUCKETS = (20, 80, 200)
+
+# Phonemized model inputs are cached per (text, voice) so repeated prompts skip G2P.
+PHONEME_CACHE_SIZE = int(os.environ.get("KITTENTTS_PHONEME_CACHE", "1024"))
+
+# KittenTTS drops this many trailing samples from every generated chunk.
+TAIL_TRIM = 5000
+
+# Responses are streamed as each text chunk is synthesized, in slices of this many samples.
+STREAM_CHUNK_SAMPLES = 4096
+
+# Rendered PCM for short inputs is kept in an LRU cache keyed by (voice, speed, input),
+# bounded to KITTENTTS_CACHE_MB in total (0 disables it).
+AUDIO_CACHE_BYTES = int(os.environ.get("KITTENTTS_CACHE_MB", "64")) * 1024 * 1024
+AUDIO_CACHE_MAX_CHARS = 200
+
+# KITTENTTS_WORKERS: uvicorn worker processes, each with its own model copy; capped
+# at startup to what fits in available memory at KITTENTTS_WORKER_MB per worker.
+WORKER_MB = int(os.environ.get("KITTENTTS_WORKER_MB", "512"))
+
+# KITTENTTS_QUANTIZE=1 statically quantizes the model to INT8 (u8 activations x s8
+# weights, the form VNNI kernels accelerate) on first start; the result is cached
+# under KITTENTTS_CACHE_DIR so later starts just load it.
+QUANTIZE = os.environ.get("KITTENTTS_QUANTIZE", "0") == "1"
+CACHE_DIR = os.environ.get(
+    "KITTENTTS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "kittentts-server")
+)
+
 # ORT_PROVIDERS: comma-separated list, e.g. "VulkanExecutionProvider,CPUExecutionProvider"
-# If unset, ORT picks from get_available_providers() automatically.
+# If unset, the first available GPU EP is used with CPU fallback, else ORT's default.
 _providers_env = os.environ.get("ORT_PROVIDERS", "").strip()
 REQUESTED_PROVIDERS = [p.strip() for p in _providers_env.split(",") if p.strip()] or None
 
+# GPU EPs probed at startup when ORT_PROVIDERS is unset, in order of preference.
+GPU_PROVIDERS = ("CUDAExecutionProvider", "DmlExecutionProvider", "VulkanExecutionProvider")
+# On these EPs the model is converted to FP16 at startup (cached like the INT8 model).
+FP16_PROVIDERS = ("CUDAExecutionProvider", "DmlExecutionProvider")
+# ORT_GPU_MEM_MB: memory cap for EPs that support one (CUDA).
+GPU_MEM_MB = int(os.environ.get("ORT_GPU_MEM_MB", "2048"))
+
+# ORT_INTRA_THREADS: intra-op thread pool size per session. ORT otherwise spawns one
+# thread per core, which oversubscribes the CPU alongside uvicorn.
+INTRA_THREADS = int(os.environ.get("ORT_INTRA_THREADS", "4"))
+
+# ORT_OPT_CACHE: directory for graph-optimized models. The first start saves the
+# fully optimized graph there in ORT format; later starts load it with graph
+# optimization disabled instead of re-running the optimizers. Entries are keyed by
+# model, providers, ORT version and CPU, since ORT_ENABLE_ALL output is CPU-specific.
+OPT_CACHE = os.environ.get("ORT_OPT_CACHE", "").strip() or None
+
+# Shared CPU arena so every session (and every request) draws from one pooled
+# allocator instead of growing its own. max_dead_bytes_per_chunk stays at ORT's
+# default (-1): 0 makes the BFC arena abort on "Could not find Region" at the
+# first run that frees a chunk.
+ort.create_and_register_allocator(
+    ort.OrtMemoryInfo("Cpu", ort.OrtAllocatorType.ORT_ARENA_ALLOCATOR, 0, ort.OrtMemType.DEFAULT),
+    ort.OrtArenaCfg(0, 1, 1 << 20, -1),
+)
+
+
+def _session_options() -> ort.SessionOptions:
+    opts = ort.SessionOptions()
+    opts.intra_op_num_threads = INTRA_THREADS
+    opts.inter_op_num_threads = 1
+    opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.add_session_config_entry("session.use_env_allocators", "1")
+    return opts
+
+
+def _provider_options(providers: list[str]) -> list[dict]:
+    options = []
+    for provider in providers:
+        if provider == "CUDAExecutionProvider":
+            options.append({
+                "device_id": 0,
+                "gpu_mem_limit": GPU_MEM_MB * 1024 * 1024,
+                "arena_extend_strategy": "kSameAsRequested",
+            })
+        elif provider == "DmlExecutionProvider":
+            options.append({"device_id": 0})
+        else:
+            options.append({})
+    return options
+
+
+@functools.cache
+def _cpu_identity() -> str:
+    """CPU model and feature flags; ORT_ENABLE_ALL output is only valid on matching CPUs."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            first_cpu = f.read().split("\n\n")[0]
+    except OSError:
+        return platform.machine()
+    info = {}
+    for line in first_cpu.splitlines():
+        name, _, value = line.partition(":")
+        info[name.strip()] = value.strip()
+    return ":".join(info.get(k, "") for k in ("vendor_id", "model name", "flags"))
+
+
+def _optimized_model_path(path, providers) -> str:
+    st = os.stat(path)
+    key = (
+        f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}:{providers}:{ort.__version__}:"
+        f"{_cpu_identity()}"
+    )
+    return os.path.join(OPT_CACHE, hashlib.sha256(key.encode()).hexdigest()[:16] + ".ort")
+
+
 # Monkey-patch ort.InferenceSession so KittenTTS (which doesn't accept a providers arg)
-# uses our provider list when it constructs its session.
+# uses our provider list and session options when it constructs its session.
 _OrigInferenceSession = ort.InferenceSession
 
 class _PatchedSession(_OrigInferenceSession):
     def __init__(self, path_or_bytes, sess_options=None, providers=None, **kwargs):
         effective = providers if providers is not None else REQUESTED_PROVIDERS
-        super().__init__(path_or_bytes, sess_options=sess_options, providers=effective, **kwargs)
+        # What to rebuild from on CPU fallback; _convert_fp16 points this at the
+        # FP32 model so the FP16 graph never ends up running on CPU.
+        self._cpu_source = path_or_bytes
+        if effective and "provider_options" not in kwargs:
+            kwargs["provider_options"] = _provider_options(effective)
+        if sess_options is not None:
+            super().__init__(path_or_bytes, sess_options=sess_options, providers=effective, **kwargs)
+        elif OPT_CACHE and isinstance(path_or_bytes, (str, os.PathLike)):
+            self._load_optimized(path_or_bytes, effective, **kwargs)
+        else:
+            self._load(path_or_bytes, effective, **kwargs)
+
+    def _load(self, path_or_bytes, providers, optimize=True, optimized_path=None, **kwargs):
+        """Create the session with this server's default session options."""
+        opts = _session_options()
+        if not optimize:
+            opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        if optimized_path:
+            opts.optimized_model_filepath = optimized_path
+        super().__init__(path_or_bytes, sess_options=opts, providers=providers, **kwargs)
+
+    def _load_optimized(self, path, providers, **kwargs):
+        """Load path through the ORT_OPT_CACHE, populating the cache on a miss."""
+        cached = _optimized_model_path(path, providers)
+        if os.path.exists(cached):
+            try:
+                self._load(cached, providers, optimize=False, **kwargs)
+                return
+            except Exception as e:
+                logger.warning(f"Discarding unusable optimized model {cached}: {e}")
+                try:
+                    os.remove(cached)
+                except OSError:
+                    pass
+
+        # ORT writes the optimized model while creating the session; write it to a
+        # private file and rename so other workers never load a partial one.
+        os.makedirs(OPT_CACHE, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=OPT_CACHE, prefix=os.path.basename(cached) + ".", suffix=".ort")
+        os.close(fd)
+        try:
+            self._load(path, providers, optimized_path=tmp, **kwargs)
+            os.replace(tmp, cached)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def run(self, output_names, input_feed, run_options=None):
+        try:
+            return super().run(output_names, input_feed, run_options)
+        except OrtFail as e:
+            if not self._fall_back_to_cpu(e):
+                raise
+            return super().run(output_names, input_feed, run_options)
+
+    def _fall_back_to_cpu(self, error: Exception) -> bool:
+        # Some EPs (notably Vulkan) fail at run time, e.g. on OOM, rather than
+        # handing nodes back to CPU, so rebuild the session CPU-only with fresh
+        # CPU session options.
+        if self.get_providers() == ["CPUExecutionProvider"]:
+            return False
+        logger.warning(f"ORT run failed on {self.get_providers()[0]}, falling back to CPU: {error}")
+        cpu_source = self._cpu_source
+        self.__init__(cpu_source, providers=["CPUExecutionProvider"])
+        self._cpu_source = cpu_source
+        return True
 
 ort.InferenceSession = _PatchedSession
 
 tts = None
 active_providers: list[str] = []
+_queue: asyncio.Queue | None = None
+_audio_cache: OrderedDict[tuple, bytes] = OrderedDict()
+_audio_cache_size = 0
+
+CALIBRATION_TEXTS = [
+    "Hello.",
+    "The quick brown fox jumps over the lazy dog.",
+    "Your order has shipped and should arrive within three to five business days.",
+    "Welcome back! You have two new messages, one missed call, and a reminder for tomorrow at nine.",
+]
+
+# Roughly 10, 50 and 150 characters.
+WARMUP_TEXTS = [
+    "Warming up",
+    "Warming up the speech model before serving traffic.",
+    "Warming up the speech model before serving traffic, so that the first "
+    "request after startup runs as fast as every request that comes after it.",
+]
+
+
+def _cache_path(suffix: str) -> str:
+    """Path of a cached model artifact derived from MODEL_ID."""
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", MODEL_ID)
+    return os.path.join(CACHE_DIR, f"{name}.{suffix}.onnx")
+
+
+def _write_cached(dst: str, write) -> None:
+    """Create dst by calling write(tmp_path) on a private temp file and renaming it
+    into place, so concurrent workers never see or clobber a partial artifact."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, prefix=os.path.basename(dst) + ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _cpu_has_vnni() -> bool:
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_vnni" in flags or "avx_vnni" in flags
+
+
+def _quantize_int8(model) -> None:
+    """Swap model.session for a statically INT8-quantized copy of the same graph."""
+    from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_static
+
+    src = getattr(model, "model_path", None)
+    if not src or not os.path.isfile(src):
+        logger.warning("INT8 quantization skipped: ONNX model path not found")
+        return
+
+    # Pre-VNNI CPUs emulate u8*s8 with VPMADDUBSW, which saturates at 16 bits
+    # unless weights are limited to 7 bits. The artifact differs accordingly.
+    reduce_range = not _cpu_has_vnni()
+    dst = _cache_path("int8-rr" if reduce_range else "int8")
+    if not os.path.exists(dst):
+        class _Reader(CalibrationDataReader):
+            def __init__(self):
+                self._inputs = (
+                    model._prepare_inputs(text, voice, 1.0)
+                    for voice in VOICE_MAP.values()
+                    for text in CALIBRATION_TEXTS
+                )
+
+            def get_next(self):
+                return next(self._inputs, None)
+
+        logger.info(f"Quantizing {src} to INT8 (reduce_range={reduce_range})")
+        _write_cached(dst, lambda tmp: quantize_static(
+            src,
+            tmp,
+            _Reader(),
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            reduce_range=reduce_range,
+        ))
+
+    logger.info(f"Loading INT8 model: {dst}")
+    model.session = ort.InferenceSession(dst)
+
+
+def _convert_fp16(model) -> None:
+    """Swap model.session for an FP16 copy of the graph (GPU EPs only; FP16 is slow on CPU)."""
+    import onnx
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+
+    src = getattr(model, "model_path", None)
+    if not src or not os.path.isfile(src):
+        logger.warning("FP16 conversion skipped: ONNX model path not found")
+        return
+
+    dst = _cache_path("fp16")
+    if not os.path.exists(dst):
+        logger.info(f"Converting {src} to FP16")
+        fp16 = convert_float_to_float16(onnx.load(src), keep_io_types=True)
+        _write_cached(dst, lambda tmp: onnx.save(fp16, tmp))
+
+    logger.info(f"Loading FP16 model: {dst}")
+    model.session = ort.InferenceSession(dst)
+    model.session._cpu_source = src
+
+
+def _bucket(text: str) -> int:
+    for i, limit in enumerate(LENGTH_BUCKETS):
+        if len(text) < limit:
+            return i
+    return len(LENGTH_BUCKETS)
+
+
+@functools.lru_cache(maxsize=PHONEME_CACHE_SIZE)
+def _phonemize(text: str, voice: str) -> tuple[dict, ...]:
+    """ONNX inputs for each text chunk at speed 1.0, as KittenTTS would build them.
+
+    Mirrors tts.generate's default clean_text=False: the text is not run through
+    KittenTTS's text preprocessor.
+    """
+    from kittentts.onnx_model import chunk_text
+
+    model = tts.model
+    chunks = []
+    for chunk in chunk_text(text):
+        inputs = model._prepare_inputs(chunk, voice, 1.0)
+        for value in inputs.values():
+            value.setflags(write=False)
+        chunks.append(inputs)
+    return tuple(chunks)
+
+
+def _generate_from_tokens(chunks: tuple[dict, ...], speed: float) -> Iterator[np.ndarray]:
+    session = tts.model.session
+    for inputs in chunks:
+        # inputs["speed"] already carries the voice's speed prior.
+        feed = dict(inputs, speed=inputs["speed"] * np.float32(speed))
+        yield session.run(None, feed)[0][..., :-TAIL_TRIM]
+
+
+def _generate(text: str, voice: str, speed: float) -> Iterator[np.ndarray]:
+    """Yield the waveform for text one synthesized chunk at a time."""
+    if not hasattr(tts.model, "_prepare_inputs"):
+        yield tts.generate(text, voice=voice, speed=speed)
+        return
+    yield from _generate_from_tokens(_phonemize(text, voice), speed)
+
+
+async def _batch_worker(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        # KittenTTS runs one utterance per forward pass, so there is nothing to gain
+        # from waiting for a fuller batch: whatever is queued is synthesized
+        # sequentially, shortest bucket first. Only this worker touches the
+        # session, so requests never contend for it.
+        batch.sort(key=lambda job: _bucket(job[2]))
+        for stream, cancelled, text, voice, speed in batch:
+            if cancelled.is_set():
+                continue
+            chunks = _generate(text, voice, speed)
+            try:
+                while not cancelled.is_set() and (
+                    audio := await loop.run_in_executor(None, next, chunks, None)
+                ) is not None:
+                    stream.put_nowait(audio)
+            except Exception as e:
+                stream.put_nowait(e)
+            else:
+                stream.put_nowait(None)
+
+
+def _warmup() -> None:
+    """Run a few short/medium/long generations so kernel selection, weight
+    packing and arena growth happen before the first real request."""
+    for text in WARMUP_TEXTS:
+        try:
+            for _ in _generate(text, NATIVE_VOICES[0], 1.0):
+                pass
+        except Exception as e:
+            logger.warning(f"Warmup generation failed: {e}")
+            return
+    logger.info("Warmup complete")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global tts, active_providers
+    global tts, active_providers, _queue, REQUESTED_PROVIDERS
     available = ort.get_available_providers()
     logger.info(f"ORT available providers: {available}")
+    if REQUESTED_PROVIDERS is None:
+        gpu = next((p for p in GPU_PROVIDERS if p in available), None)
+        if gpu is not None:
+            REQUESTED_PROVIDERS = [gpu, "CPUExecutionProvider"]
     logger.info(f"ORT requested providers: {REQUESTED_PROVIDERS or '(auto)'}")
     logger.info(f"Loading KittenTTS model: {MODEL_ID}")
     from kittentts import KittenTTS
     tts = KittenTTS(MODEL_ID)
     active_providers = tts.model.session.get_providers()
+    if any(p in active_providers for p in FP16_PROVIDERS):
+        try:
+            _convert_fp16(tts.model)
+        except Exception as e:
+            logger.error(f"FP16 conversion failed, keeping FP32 model: {e}")
+    elif QUANTIZE:
+        try:
+            _quantize_int8(tts.model)
+        except Exception as e:
+            logger.error(f"INT8 quantization failed, keeping FP32 model: {e}")
+    active_providers = tts.model.session.get_providers()
     logger.info(f"ORT active providers: {active_providers}")
+    _warmup()
+    _queue = asyncio.Queue()
+    worker = asyncio.create_task(_batch_worker(_queue))
     yield
+    worker.cancel()
 
 
 app = FastAPI(title="KittenTTS OpenAI-compatible server", lifespan=lifespan)
@@ -68,66 +461,272 @@ NATIVE_VOICES = [
     "expr-voice-5-m", "expr-voice-5-f",
 ]
 
+# Case-folded lookups, so a request's voice is resolved with one lower() and dict hits.
+VOICE_MAP_LC = {k.lower(): sys.intern(v) for k, v in VOICE_MAP.items()}
+NATIVE_VOICES_LC = {v.lower(): v for v in NATIVE_VOICES}
+
+
+RESPONSE_FORMATS = frozenset({"wav", "mp3", "opus", "aac", "flac", "pcm"})
+
 
-class SpeechRequest(BaseModel):
+class SpeechRequest(msgspec.Struct, kw_only=True):
     model: str = "tts-1"
     input: str
     voice: str = "alloy"
-    response_format: Literal["wav", "mp3", "opus", "aac", "flac", "pcm"] = "wav"
-    speed: float = 1.0
+    response_format: str = "wav"
+    speed: Annotated[float, msgspec.Meta(ge=0.25, le=4.0)] = 1.0
+
+
+def _to_pcm16(audio: np.ndarray) -> np.ndarray:
+    pcm = np.clip(audio, -1.0, 1.0).astype(np.float32, copy=False)
+    pcm *= 32767.0
+    return pcm.astype("<i2")
+
+
+def _wav_header(data_size: int | None = None) -> bytes:
+    """44-byte header for mono 16-bit PCM WAV at SAMPLE_RATE.
+
+    Without a data_size the RIFF and data sizes are set to 0xFFFFFFFF, the
+    usual marker for a WAV stream of unknown length.
+    """
+    riff_size = 36 + data_size if data_size is not None else 0xFFFFFFFF
+    data_size = data_size if data_size is not None else 0xFFFFFFFF
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", riff_size, b"WAVE",
+        b"fmt ", 16, 1, 1, SAMPLE_RATE, SAMPLE_RATE * 2, 2, 16,
+        b"data", data_size,
+    )
+
+
+def _audio_cache_get(key: tuple) -> bytes | None:
+    pcm = _audio_cache.get(key)
+    if pcm is not None:
+        _audio_cache.move_to_end(key)
+    return pcm
+
+
+def _audio_cache_put(key: tuple, pcm: bytes) -> None:
+    global _audio_cache_size
+    if key in _audio_cache or len(pcm) > AUDIO_CACHE_BYTES:
+        return
+    _audio_cache[key] = pcm
+    _audio_cache_size += len(pcm)
+    while _audio_cache_size > AUDIO_CACHE_BYTES:
+        _, evicted = _audio_cache.popitem(last=False)
+        _audio_cache_size -= len(evicted)
+
+
+# Declared return types let FastAPI serialize these responses straight to JSON
+# bytes with pydantic-core instead of going through json.dumps.
+class HealthResponse(BaseModel):
+    status: str
+    model: str
+    ready: bool
+    ort_providers: list[str]
+
+
+class ModelInfo(BaseModel):
+    id: str
+    object: str = "model"
+
+
+class ModelList(BaseModel):
+    object: str = "list"
+    data: list[ModelInfo]
+
+
+class VoiceList(BaseModel):
+    voices: list[str]
 
 
 @app.get("/health")
-def health():
-    return {
-        "status": "ok",
-        "model": MODEL_ID,
-        "ready": tts is not None,
-        "ort_providers": active_providers,
-    }
+def health() -> HealthResponse:
+    return HealthResponse(
+        status="ok",
+        model=MODEL_ID,
+        ready=tts is not None,
+        ort_providers=tts.model.session.get_providers() if tts is not None else [],
+    )
 
 
 @app.get("/v1/models")
-def list_models():
-    return {
-        "object": "list",
-        "data": [
-            {"id": "tts-1", "object": "model"},
-            {"id": "tts-1-hd", "object": "model"},
-        ],
-    }
+def list_models() -> ModelList:
+    return ModelList(data=[ModelInfo(id="tts-1"), ModelInfo(id="tts-1-hd")])
 
 
 @app.get("/v1/audio/voices")
-def list_voices():
-    return {"voices": NATIVE_VOICES}
+def list_voices() -> VoiceList:
+    return VoiceList(voices=NATIVE_VOICES)
+
 
+# The body is decoded by hand, so describe it to OpenAPI explicitly.
+_SPEECH_REQUEST_SCHEMA = msgspec.json.schema_components([SpeechRequest])[1]["SpeechRequest"]
+_SPEECH_REQUEST_SCHEMA["properties"]["response_format"]["enum"] = sorted(RESPONSE_FORMATS)
+
+
+@app.post(
+    "/v1/audio/speech",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": _SPEECH_REQUEST_SCHEMA}},
+        }
+    },
+)
+async def audio_speech(request: Request):
+    # Decoded with msgspec rather than a pydantic body model: same checks, far
+    # less per-request CPU.
+    try:
+        req = msgspec.json.decode(await request.body(), type=SpeechRequest)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if req.response_format not in RESPONSE_FORMATS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"response_format must be one of {sorted(RESPONSE_FORMATS)}",
+        )
+    if not req.input.strip():
+        raise HTTPException(status_code=422, detail="input must not be empty")
 
-@app.post("/v1/audio/speech")
-def audio_speech(req: SpeechRequest):
     if tts is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
 
-    voice = VOICE_MAP.get(req.voice.lower(), req.voice)
-    speed = max(0.25, min(4.0, req.speed))
+    vl = req.voice.lower()
+    voice = VOICE_MAP_LC.get(vl) or NATIVE_VOICES_LC.get(vl) or req.voice
+    # Rounded once so the cache key and the synthesized audio always agree.
+    speed = round(req.speed, 2)
+
+    media_type = "audio/pcm" if req.response_format == "pcm" else "audio/wav"
+
+    key = (voice, speed, req.input)
+    cacheable = len(req.input) < AUDIO_CACHE_MAX_CHARS
+    if cacheable:
+        cached = _audio_cache_get(key)
+        if cached is not None:
+            if req.response_format != "pcm":
+                cached = _wav_header(len(cached)) + cached
+            return Response(content=cached, media_type=media_type)
+
+    stream = asyncio.Queue()
+    # Set when the client goes away, so the worker skips or stops this job.
+    cancelled = asyncio.Event()
+    await _queue.put((stream, cancelled, req.input, voice, speed))
+    try:
+        first = await stream.get()
+    except BaseException:
+        cancelled.set()
+        raise
+    if isinstance(first, Exception):
+        logger.error(f"Generation failed: {first}")
+        raise HTTPException(status_code=500, detail=str(first))
+    if first is None:
+        # Nothing to stream (e.g. the text phonemized to no tokens); don't send
+        # a bare header or cache empty audio.
+        raise HTTPException(status_code=500, detail="No audio generated")
+
+    async def body():
+        if req.response_format != "pcm":
+            yield _wav_header()
+        parts = []
+        audio = first
+        try:
+            while audio is not None:
+                if isinstance(audio, Exception):
+                    # Headers are already sent; all we can do is end the stream early.
+                    logger.error(f"Generation failed mid-stream: {audio}")
+                    return
+                # Ensure 1D; reshape is a view when the model output is already contiguous.
+                if audio.ndim > 1:
+                    audio = np.ascontiguousarray(audio.reshape(-1))
+                pcm = _to_pcm16(audio)
+                for start in range(0, len(pcm), STREAM_CHUNK_SAMPLES):
+                    data = pcm[start:start + STREAM_CHUNK_SAMPLES].tobytes()
+                    if cacheable:
+                        parts.append(data)
+                    yield data
+                audio = await stream.get()
+            if cacheable:
+                _audio_cache_put(key, b"".join(parts))
+        finally:
+            # Runs on disconnect too (the iterator is cancelled or closed).
+            cancelled.set()
+
+    return StreamingResponse(body(), media_type=media_type)
 
+
+def _fit_workers(requested: int) -> int:
+    """Cap the worker count so each worker's model copy fits in available memory."""
     try:
-        audio = tts.generate(req.input, voice=voice, speed=speed)
-    except Exception as e:
-        logger.error(f"Generation failed: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        with open("/proc/meminfo") as f:
+            meminfo = dict(line.split(":", 1) for line in f)
+        available_mb = int(meminfo["MemAvailable"].split()[0]) // 1024
+    except (OSError, KeyError, ValueError):
+        return requested
+    fitted = max(1, min(requested, available_mb // WORKER_MB))
+    if fitted < requested:
+        logger.warning(
+            f"Reducing workers from {requested} to {fitted}: "
+            f"{available_mb} MB available, {WORKER_MB} MB per worker"
+        )
+    return fitted
+
+
+def _parse_cpulist(cpulist: str) -> set[int]:
+    cpus = set()
+    for part in cpulist.strip().split(","):
+        if "-" in part:
+            lo, hi = part.split("-")
+            cpus.update(range(int(lo), int(hi) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
 
-    # Ensure 1D float32
-    if audio.ndim > 1:
-        audio = audio.squeeze()
 
-    buf = io.BytesIO()
-    sf.write(buf, audio, SAMPLE_RATE, format="WAV", subtype="PCM_16")
-    buf.seek(0)
-    return Response(content=buf.read(), media_type="audio/wav")
+def _pin_cpus() -> None:
+    """Bind the process to NUMA node 0's cores (first KITTENTTS_CPUS of them if set),
+    so ORT threads stream weights from local memory."""
+    if not hasattr(os, "sched_setaffinity"):
+        return
+    allowed = os.sched_getaffinity(0)
+    cpus = allowed
+    nodes = sorted(glob.glob("/sys/devices/system/node/node[0-9]*"))
+    if len(nodes) > 1:
+        with open(os.path.join(nodes[0], "cpulist")) as f:
+            cpus = (_parse_cpulist(f.read()) & allowed) or allowed
+    count = os.environ.get("KITTENTTS_CPUS", "").strip()
+    if count:
+        try:
+            n = int(count)
+        except ValueError:
+            n = 0
+        if n >= 1:
+            cpus = set(sorted(cpus)[:n])
+        else:
+            logger.warning(f"Ignoring KITTENTTS_CPUS={count!r}: expected a positive integer")
+    if cpus != allowed:
+        os.sched_setaffinity(0, cpus)
+    logger.info(f"CPU affinity: {sorted(os.sched_getaffinity(0))}")
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", "8080"))
-    uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
+    _pin_cpus()
+    workers = _fit_workers(int(os.environ.get("KITTENTTS_WORKERS", "1")))
+    preload = os.environ.get("LD_PRELOAD", "")
+    if "mimalloc" in preload:
+        logger.info(f"Using mimalloc allocator: {preload}")
+    else:
+        logger.info("Using system allocator (set LD_PRELOAD to libmimalloc to override)")
+    # Each worker is a separate process that imports this module and loads its
+    # own model, which requires passing the app as an import string.
+    uvicorn.run(
+        "server:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=port,
+        log_level="info",
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+    )